@@ -2,7 +2,7 @@
 # -*- encoding: utf-8 -*-
 
 import json
-import pandas_datareader as pdr
+import numpy as np
 import pandas as pd
 import requests
 import datetime as dt
@@ -21,7 +21,9 @@ INDEX_CONTRACT_MULT = 50
 
 USD_HKD_FX = 7.72
 
-SOURCE = 'yahoo'
+YAHOO_CHART_URL = 'https://query1.finance.yahoo.com/v8/finance/chart/{}'
+
+YAHOO_HEADERS = {'User-Agent': 'Mozilla/5.0'}
 
 
 def parse_args():
@@ -54,21 +56,41 @@ def parse_json(json_data):
     content_dict = json.loads(json_data)
     table = content_dict['tables'][0]
     columns = parse_header(table['header'])
-    data = [v['text'] for v in table['body']]
+    data = np.asarray([v['text'] for v in table['body']], dtype=object)
 
     if len(data) % len(columns) != 0:
         raise ValueError('an error occurred in parsing the columns')
 
     rows = int(len(data) / len(columns))
     column_length = len(columns)
-    table_data = [data[column_length*i:column_length*(i+1)] for i in range(rows)]
-    df = pd.DataFrame(table_data, columns=columns)
-    df.loc[:, 'Year'] = df.Year.apply(lambda x: x.split(' ')[0]).astype(int)
+    df = pd.DataFrame(data.reshape(rows, column_length), columns=columns)
+    df['Year'] = df.Year.str.split(' ').str[0].astype(int)
     df.set_index('Year', drop=True, inplace=True)
-    df = df.applymap(lambda x: x.replace(',', '')).astype(float)
+    df = df.apply(lambda column: column.str.replace(',', '', regex=False)).astype(float)
     return df
 
 
+def parse_chart_json(json_data):
+    result = json.loads(json_data)['chart']['result'][0]
+    timezone = result['meta']['exchangeTimezoneName']
+    dates = pd.to_datetime(result['timestamp'], unit='s', utc=True).tz_convert(timezone)
+    dates = dates.tz_localize(None).normalize()
+    close = result['indicators']['quote'][0]['close']
+    return pd.DataFrame({'Close': close}, index=pd.Index(dates, name='Date'), dtype=np.float64)
+
+
+def get_close_prices(symbol, start, end):
+    start = dt.datetime.combine(start, dt.time())
+    end = dt.datetime.combine(end + dt.timedelta(days=1), dt.time())
+    params = {'period1': int(start.timestamp()), 'period2': int(end.timestamp()), 'interval': '1d'}
+
+    url = YAHOO_CHART_URL.format(symbol)
+    logging.info('downloading close prices from: {}'.format(url))
+    req = requests.get(url, params=params, headers=YAHOO_HEADERS)
+    req.raise_for_status()
+    return parse_chart_json(req.content.decode('utf-8'))
+
+
 def main():
 
     args = parse_args()
@@ -81,14 +103,14 @@ def main():
     volume_df = parse_json(content)
     start = dt.date(int(volume_df.index[0]), 1, 1)
     end = dt.date.today()
-    close_price_data = pdr.data.DataReader('^{}'.format(args.symbol), SOURCE, start, end)
-    average_close = close_price_data.resample('Y').Close.mean()
-
-    average_close.index = [v.year for v in average_close.index]
+    close_price_data = get_close_prices('^{}'.format(args.symbol), start, end)
+    average_close = close_price_data['Close'].groupby(close_price_data.index.year).mean()
     average_close.index.name = 'Year'
     average_close.name = '{} average spot'.format(args.symbol)
 
-    stats_df = volume_df.join(average_close, how='inner')
+    # keep the inner join semantics: years without a price are dropped
+    stats_df = volume_df.assign(**{average_close.name: average_close.reindex(volume_df.index)})
+    stats_df = stats_df.dropna(subset=[average_close.name])
 
     stats_df['notional'] = (stats_df['Contract Volume-Average Daily']
                             * stats_df["{} average spot".format(args.symbol)]
@@ -5,21 +5,47 @@ import logging
 import aiohttp
 import async_timeout
 import io
+import os
+import zipfile
+import tempfile
+from pathlib import Path
+from email.utils import formatdate, parsedate_to_datetime
+from functools import lru_cache
 import asyncio
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pa_csv
 import datetime as dt
 import argparse
-import pandas_datareader as pdr
+import json
 import matplotlib.pyplot as plt
 
 logging.basicConfig(level=logging.INFO)
 
 HKEX_URL_ROOT = 'https://www.hkex.com.hk/eng/cbbc/download/CBBC{:02d}.zip'
 
-SOURCE = 'yahoo'
+CHUNK_SIZE = 131072
+
+HKEX_TZ = dt.timezone(dt.timedelta(hours=8))
+
+PARSED_CACHE_DIR = Path.home() / '.cache' / 'cbbc'
+
+YAHOO_CHART_URL = 'https://query1.finance.yahoo.com/v8/finance/chart/{}'
+
+YAHOO_HEADERS = {'User-Agent': 'Mozilla/5.0'}
 
 USD_HKD_FX = 7.72
 
+HKD_TO_USD_MM = 1 / (USD_HKD_FX * 1e6)
+
+VALUE_COLUMNS = ['index units traded', 'Volume', 'Turnover']
+
+COLUMN_NAME_TABLE = str.maketrans({'*': '', '^': '', '%': 'percent'})
+
+FLOAT32_COLUMNS = {'Ent. Ratio': np.float32, 'Turnover': np.float32}
+
 
 def str_lower(string):
     return string.lower()
@@ -38,6 +64,7 @@ def parse_args():
     return args
 
 
+@lru_cache(maxsize=None)
 def adjust_symbol(symbol):
     if symbol.isnumeric():
         dts_symbol = '{:05d}'.format(int(symbol))
@@ -53,32 +80,108 @@ def adjust_symbol(symbol):
     return dts_symbol, yahoo_symbol
 
 
-async def download_coroutine(session, url, data_dict):
-    logging.info('attempting download of {}'.format(url))
+def cbbc_year(month, today):
+    # hkex publishes the trailing 12 months, so months after the current one belong to last year
+    return today.year if month <= today.month else today.year - 1
+
+
+def cbbc_month_closed(cache_path, month, today):
+    # the cached zip carries the server's Last-Modified, so a file hkex last changed after its month
+    # ended (midnight hkt) holds the whole month and will not change again
+    year = cbbc_year(month, today)
+    month_end = dt.datetime(year + month // 12, month % 12 + 1, 1, tzinfo=HKEX_TZ)
+    return cache_path.stat().st_mtime >= month_end.timestamp()
+
+
+def parsed_cache_prefix(cache_path, dts_symbol):
+    return '{}_{}'.format(cache_path.stem, dts_symbol)
+
+
+def parsed_cache_path(cache_path, dts_symbol):
+    # keyed on the version of the cached zip, which only changes when a 200 response replaces it
+    PARSED_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    version = cache_path.stat().st_mtime_ns
+    return PARSED_CACHE_DIR / '{}_{}.parquet'.format(parsed_cache_prefix(cache_path, dts_symbol), version)
+
+
+def cbbc_cache_path(file_name, today):
+    month = int(file_name[len('CBBC'):-len('.zip')])
+    return Path(tempfile.gettempdir()) / 'CBBC{:02d}_{}.zip'.format(month, cbbc_year(month, today)), month
+
+
+async def download_coroutine(session, url):
+    # returns None in place of the bytes when the cached zip is already current, along with
+    # the response's Last-Modified as a timestamp when one was sent
     file_name = url.split('/')[-1]
+    today = dt.date.today()
+    cache_path, month = cbbc_cache_path(file_name, today)
+
+    headers = {}
+    if cache_path.exists():
+        if cbbc_month_closed(cache_path, month, today):
+            logging.info('using cached {} at {}'.format(file_name, cache_path))
+            return file_name, None, None
+        headers['If-Modified-Since'] = formatdate(cache_path.stat().st_mtime, usegmt=True)
+
+    logging.info('attempting download of {}'.format(url))
     with async_timeout.timeout(600):
-        async with session.get(url) as response:
-            bytes_written = 0
-            last_log = dt.datetime.now()
-            with io.BytesIO() as buffer:
-                while True:
-                    chunk = await response.content.read(1024)
-                    if not chunk:
-                        break
-                    bytes_written += buffer.write(chunk)
-                    if dt.datetime.now() - last_log > dt.timedelta(seconds=15):
-                        logging.info('file: {} has written {} bytes into buffer'.format(
-                                     file_name, bytes_written))
-                        last_log = dt.datetime.now()
-
-                df = pd.read_csv(buffer, compression='zip', encoding='utf-16', sep='\t', dtype={'CBBC Code': str})
-
-    raw_length = len(df)
-    # .loc does not play well with str.extract here for reasons unknown. works fine when tested on small dataframes
-    df['CBBC Code'] = df['CBBC Code'].str.extract(r'(\d+)')
-
-    mask = ~df['CBBC Code'].isna()
-    df = df.loc[mask, :]
+        async with session.get(url, headers=headers) as response:
+            if response.status == 304:
+                logging.info('{} not modified, using cache {}'.format(file_name, cache_path))
+                return file_name, None, None
+            response.raise_for_status()
+            last_modified = response.headers.get('Last-Modified')
+            modified = parsedate_to_datetime(last_modified).timestamp() if last_modified else None
+            raw = bytearray()
+            async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                raw += chunk
+
+    logging.info('file: {} downloaded {} bytes'.format(file_name, len(raw)))
+
+    return file_name, raw, modified
+
+
+def store_cbbc_zip(cache_path, raw, modified):
+    # write then rename so an interrupted run cannot leave a truncated zip in the cache
+    part_path = cache_path.with_suffix('.part')
+    part_path.write_bytes(raw)
+    if not zipfile.is_zipfile(part_path):
+        part_path.unlink()
+        raise zipfile.BadZipFile('{} is not a zip file, not caching it'.format(cache_path.name))
+    # stamp with the server's time so the closed-month check and If-Modified-Since do not depend on the local clock
+    if modified is not None:
+        os.utime(part_path, (modified, modified))
+    os.replace(part_path, cache_path)
+
+
+def clean_column_names(columns):
+    return [v.translate(COLUMN_NAME_TABLE) for v in columns]
+
+
+def parse_cbbc_bytes(file_name, raw, dts_symbol):
+    # runs in a worker process so the utf-16 csv decode does not block the event loop
+    with zipfile.ZipFile(io.BytesIO(raw)) as zf:
+        text = zf.read(zf.namelist()[0]).decode('utf-16').encode('utf-8')
+
+    # short rows at the end of the file do not match the header, count them with the other bad codes
+    invalid_rows = []
+
+    def skip_invalid_row(row):
+        invalid_rows.append(row.number)
+        return 'skip'
+
+    table = pa_csv.read_csv(
+        pa.py_buffer(text),
+        parse_options=pa_csv.ParseOptions(delimiter='\t', invalid_row_handler=skip_invalid_row),
+        convert_options=pa_csv.ConvertOptions(column_types={'CBBC Code': pa.string(), 'Trade Date': pa.string()}),
+    )
+    df = table.to_pandas(self_destruct=True)
+    del table
+
+    raw_length = len(df) + len(invalid_rows)
+    # missing codes count as non-numeric
+    mask = df['CBBC Code'].str.isnumeric().fillna(False).astype(bool)
+    df = df.loc[mask, :].assign(**{'Trade Date': lambda x: pd.to_datetime(x['Trade Date'])})
     updated_length = len(df)
     removed_records = raw_length - updated_length
     log_msg = '{} raw df length: {}, removed non-numeric cbbc codes, new length: {}. \033[32m {} records removed' \
@@ -92,15 +195,131 @@ async def download_coroutine(session, url, data_dict):
             removed_records
         ))
 
-    data_dict[file_name] = df
-
-    return await response.release()
-
-
-async def get_data(loop, url_list, data_dict):
-
-    async with aiohttp.ClientSession(loop=loop) as session:
-        await asyncio.gather(*(download_coroutine(session, url, data_dict) for url in url_list))
+    df.columns = clean_column_names(df.columns)
+    # only the requested underlying is returned to the parent process
+    df = df.loc[df['Underlying'] == dts_symbol]
+    return df.astype(FLOAT32_COLUMNS)
+
+
+def parse_chart_json(json_data):
+    result = json.loads(json_data)['chart']['result'][0]
+    timezone = result['meta']['exchangeTimezoneName']
+    trade_dates = pd.to_datetime(result['timestamp'], unit='s', utc=True).tz_convert(timezone)
+    trade_dates = trade_dates.tz_localize(None).normalize()
+    close = result['indicators']['quote'][0]['close']
+    return pd.DataFrame({'Close': close}, index=pd.Index(trade_dates, name='Trade Date'), dtype=np.float64)
+
+
+async def download_close_prices(session, yahoo_symbol):
+    today = dt.date.today()
+    first_month = today.month % 12 + 1
+    start = dt.datetime(cbbc_year(first_month, today), first_month, 1)
+    end = dt.datetime.combine(today + dt.timedelta(days=1), dt.time())
+    params = {'period1': int(start.timestamp()), 'period2': int(end.timestamp()), 'interval': '1d'}
+
+    url = YAHOO_CHART_URL.format(yahoo_symbol)
+    logging.info('downloading close prices from: {}'.format(url))
+    with async_timeout.timeout(60):
+        async with session.get(url, params=params, headers=YAHOO_HEADERS) as response:
+            response.raise_for_status()
+            content = await response.text()
+
+    return parse_chart_json(content)
+
+
+async def download_and_parse(loop, session, executor, url, dts_symbol):
+    file_name, raw, modified = await download_coroutine(session, url)
+    cache_path, _ = cbbc_cache_path(file_name, dt.date.today())
+    from_cache = raw is None
+
+    # parsed frames are only reused when the zip was confirmed current, by a closed month or a 304
+    if from_cache:
+        parquet_path = parsed_cache_path(cache_path, dts_symbol)
+        if parquet_path.exists():
+            logging.info('loading parsed {} from {}'.format(file_name, parquet_path))
+            return file_name, pd.read_parquet(parquet_path)
+        raw = cache_path.read_bytes()
+
+    try:
+        df = await loop.run_in_executor(executor, parse_cbbc_bytes, file_name, raw, dts_symbol)
+    except Exception:
+        # a cached zip that no longer parses is dropped so the next run downloads it again
+        if from_cache:
+            logging.info('removing unreadable cached {}'.format(cache_path))
+            cache_path.unlink()
+        raise
+
+    # downloads only enter the cache once they have parsed and passed the record check
+    if not from_cache:
+        store_cbbc_zip(cache_path, raw, modified)
+    parquet_path = parsed_cache_path(cache_path, dts_symbol)
+
+    for stale_path in PARSED_CACHE_DIR.glob('{}_*.parquet'.format(parsed_cache_prefix(cache_path, dts_symbol))):
+        stale_path.unlink()
+    part_path = parquet_path.with_suffix('.part')
+    df.to_parquet(part_path, compression='zstd', index=False)
+    os.replace(part_path, parquet_path)
+    return file_name, df
+
+
+async def get_data(loop, url_list, data_dict, dts_symbol, yahoo_symbol=None):
+
+    # allow one connection per file and keep them alive for reuse
+    connector = aiohttp.TCPConnector(limit_per_host=len(url_list), keepalive_timeout=75,
+                                     enable_cleanup_closed=True, loop=loop)
+    async with aiohttp.ClientSession(connector=connector, loop=loop) as session:
+        # the close price request only needs the trailing 12 month window, so it can overlap the zip downloads
+        price_task = asyncio.create_task(download_close_prices(session, yahoo_symbol)) if yahoo_symbol else None
+        with ProcessPoolExecutor(max_workers=min(len(url_list), os.cpu_count() or 1)) as executor:
+            tasks = [asyncio.create_task(download_and_parse(loop, session, executor, url, dts_symbol))
+                     for url in url_list]
+            completed = False
+            try:
+                for file_name, df in await asyncio.gather(*tasks):
+                    data_dict[file_name] = df
+                completed = True
+            finally:
+                # when one file fails, stop the other downloads and the price request before the executor
+                # shuts down and the session closes under them
+                if not completed:
+                    pending = tasks + ([price_task] if price_task is not None else [])
+                    for task in pending:
+                        task.cancel()
+                    await asyncio.gather(*pending, return_exceptions=True)
+
+        if price_task is not None:
+            return await price_task
+
+
+def sum_by_date(symbol_df):
+    # group on int codes from factorize and put the sorted trade dates back as the index
+    date_codes, dates = pd.factorize(symbol_df['Trade Date'], sort=True)
+    # NaT dates get code -1, drop them as groupby('Trade Date') did
+    valid = date_codes >= 0
+    index_unit_ts = symbol_df.loc[valid, VALUE_COLUMNS].groupby(date_codes[valid]).sum()
+    index_unit_ts.index = pd.Index(dates, name='Trade Date')
+    return index_unit_ts
+
+
+def sum_by_date_and_issuer(symbol_df):
+    # equivalent to groupby(['Trade Date', 'Issuer']).sum().unstack('Issuer') using a flat accumulator over int codes
+    # a NaT date or missing issuer is dropped before factorizing, as groupby's dropna=True does
+    symbol_df = symbol_df.loc[symbol_df[['Trade Date', 'Issuer']].notna().all(axis=1)]
+    date_codes, dates = pd.factorize(symbol_df['Trade Date'], sort=True)
+    issuer_codes, issuers = pd.factorize(symbol_df['Issuer'], sort=True)
+    n_dates, n_issuers = len(dates), len(issuers)
+    flat_codes = date_codes * n_issuers + issuer_codes
+
+    out = np.empty((n_dates * n_issuers, len(VALUE_COLUMNS)))
+    for i, column in enumerate(VALUE_COLUMNS):
+        out[:, i] = np.bincount(flat_codes, weights=symbol_df[column].to_numpy(dtype=np.float64),
+                                minlength=n_dates * n_issuers)
+    # unstack leaves date/issuer pairs with no trades as NaN
+    out[np.bincount(flat_codes, minlength=n_dates * n_issuers) == 0, :] = np.nan
+
+    out = out.reshape(n_dates, n_issuers, len(VALUE_COLUMNS)).transpose(0, 2, 1)
+    columns = pd.MultiIndex.from_product([VALUE_COLUMNS, issuers], names=[None, 'Issuer'])
+    return pd.DataFrame(out.reshape(n_dates, -1), index=pd.Index(dates, name='Trade Date'), columns=columns)
 
 
 def main():
@@ -112,52 +331,36 @@ def main():
     file_urls = [HKEX_URL_ROOT.format(i) for i in range(1, 13)]
     data_dict = {}
     loop = asyncio.get_event_loop()
-    loop.run_until_complete(get_data(loop, file_urls, data_dict))
-
-    final_df = pd.concat(data_dict.values(), axis=0)
+    price_symbol = yahoo_symbol if args.value == 'notional' else None
+    close_price_data = loop.run_until_complete(get_data(loop, file_urls, data_dict, dts_symbol, price_symbol))
 
-    # clean up column names
-    column_names = [v.replace('*', '') for v in final_df.columns]
-    column_names = [v.replace('^', '') for v in column_names]
-    column_names = [v.replace('%', 'percent') for v in column_names]
-    final_df.columns = column_names
+    symbol_df = pd.concat(data_dict.values(), axis=0, ignore_index=True)
 
-    logging.info('available columns: {}'.format(final_df.columns))
-
-    symbol_df = final_df.loc[final_df.loc[:, 'Underlying'] == dts_symbol, :]
+    logging.info('available columns: {}'.format(symbol_df.columns))
 
     if len(symbol_df) == 0:
         logging.info('No CBBC volume for symbol {}'.format(dts_symbol))
         exit(0)
 
-    symbol_df.loc[:, 'index units traded'] = symbol_df.apply(lambda x: x['Volume'] / x['Ent. Ratio'], axis=1)
+    volume = symbol_df['Volume'].to_numpy(dtype=np.float64)
+    ent_ratio = symbol_df['Ent. Ratio'].to_numpy(dtype=np.float64)
+    symbol_df['index units traded'] = volume / ent_ratio
 
     if args.issuers:
-        index_unit_ts = symbol_df.groupby(['Trade Date', 'Issuer']).sum()
-        index_unit_ts = index_unit_ts.loc[:, ['index units traded', 'Volume', 'Turnover']]
-        index_unit_ts = index_unit_ts.unstack('Issuer')
+        index_unit_ts = sum_by_date_and_issuer(symbol_df)
     else:
-        index_unit_ts = symbol_df.groupby('Trade Date').sum()
-        index_unit_ts = index_unit_ts.loc[:, ['index units traded', 'Volume', 'Turnover']]
-
-    start = index_unit_ts.index[0]
-    end = index_unit_ts.index[-1]
+        index_unit_ts = sum_by_date(symbol_df)
 
     if args.value == 'notional':
-        close_price_data = pdr.data.DataReader(yahoo_symbol, SOURCE, start, end)
-        close_price_data.index.rename('Trade Date', inplace=True)
-        notional_df = index_unit_ts.loc[:, 'index units traded'].multiply(
-                        close_price_data.Close,
-                        axis=0)
-
-        notional_df *= (1/(USD_HKD_FX*1e6))
+        close = close_price_data['Close'].reindex(index_unit_ts.index).to_numpy()
+        notional_df = index_unit_ts['index units traded'].multiply(close * HKD_TO_USD_MM, axis=0)
 
         notional_df.plot(title='{} CBBC Daily Notional Traded ($MM USD)'.format(args.symbol))
 
     elif args.value == 'contracts':
         index_unit_ts['Volume'].plot(title='{} CBBC Daily Volume'.format(args.symbol))
     elif args.value == 'turnover':
-        index_unit_ts['Turnover'].apply(lambda x: x / USD_HKD_FX / 1e6).plot(
+        (index_unit_ts['Turnover'] * HKD_TO_USD_MM).plot(
             title='{} CBBC Daily Turnover Traded ($MM USD)'.format(args.symbol)
         )
 